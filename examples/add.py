@@ -23,20 +23,51 @@
 # {"Found":[{"Bindingss":[{"?z":3}]}]}
 
 from BaseHTTPServer import BaseHTTPRequestHandler,HTTPServer
-import cgi # Better way now?
+from SocketServer import ThreadingMixIn
+import Queue
+import threading
 import json
-import urllib2
-import urllib
+import logging
+try:
+    import ujson as fastjson # Faster JSON, if it's installed.
+except ImportError:
+    fastjson = json
 
 PORT = 6666
 
+# Each request's details are logged at DEBUG, which is off by default
+# to keep logging out of the request path.
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# Complete status lines and headers, built once per process.  We
+# close the connection after every reply, and say so up front.
+JSON_HEAD = 'HTTP/1.0 200 OK\r\nContent-type: application/json\r\nConnection: close\r\n\r\n'
+TEXT_HEAD = 'HTTP/1.0 200 OK\r\nContent-type: text/plain\r\nConnection: close\r\n\r\n'
+
 def protest (response, message):
-    response.send_response(200)
-    response.send_header('Content-type','text/plain')
-    response.end_headers()
-    response.wfile.write('{"Error":"%s"}' % (message))
+    response.log_request(200)
+    response.wfile.write(TEXT_HEAD + '{"Error":"%s"}' % (message))
+
+# JSON numbers only; bool is an int subclass, so rule it out.
+def isNumber (v):
+    return isinstance(v, (int, long, float)) and not isinstance(v, bool)
 
 class handler(BaseHTTPRequestHandler):
+    # Our replies are small; send them without waiting on Nagle.
+    disable_nagle_algorithm = True
+    # Buffer the status line, headers and body so they go out in one
+    # send when the request finishes rather than one send apiece.
+    wbufsize = -1
+
+    # Log each request through logger rather than straight to stderr.
+    def log_message(self, format, *args):
+        logger.debug("%s " + format, self.client_address[0], *args)
+
+    # But keep send_error's complaints visible.
+    def log_error(self, format, *args):
+        logger.warning("%s " + format, self.client_address[0], *args)
+
     def do_GET(self):
         protest(self, "You should POST with json.\n")
         return
@@ -50,26 +81,32 @@ class handler(BaseHTTPRequestHandler):
             js = self.rfile.read(content_length)
 
             # We want {"x":number,"y":number,"z":variable}. 
-            m = json.loads(js)
+            m = fastjson.loads(js)
     
             if 'x' not in m:
                 protest(self, "Need x (constant: number).\n")
                 return
             x = m["x"]
-            print 'x ', x
+            logger.debug('x %s', x)
+            if not isNumber(x):
+                protest(self, "Need x (constant: number).\n")
+                return
     
             if 'y' not in m:
                 protest(self, "Need y (constant: number).\n")
                 return
             y = m["y"]
-            print 'x ', x
+            logger.debug('y %s', y)
+            if not isNumber(y):
+                protest(self, "Need y (constant: number).\n")
+                return
     
     
             if 'z' not in m:
                 protest(self, "Need z (variable).\n")
                 return
             z = str(m["z"])
-            print 'z ', z
+            logger.debug('z %s', z)
     
             if not z.startswith("?"):
                 protest(self, "z must be a variable.\n")
@@ -81,18 +118,40 @@ class handler(BaseHTTPRequestHandler):
 
             got = x + y
 
-            self.send_response(200)
-            self.send_header('Content-type','application/json')
-            self.end_headers()
-            response = '{"Found":[{"Bindingss":[{"%s":%f}]}]}' % (z, got)
-            print 'response ', response
-            self.wfile.write(response)
+            response = fastjson.dumps({"Found": [{"Bindingss": [{z: got}]}]})
+            logger.debug('response %s', response)
+            self.log_request(200)
+            self.wfile.write(JSON_HEAD + response)
             
         except Exception as broke:
             protest(self, str(broke))
 
+# Handle requests on a fixed pool of threads, started up front, so
+# that one slow request (say, waiting on an upstream service) doesn't
+# hold up the rest and a burst of clients can't start a thread apiece.
+# When every worker is busy, new connections wait in the queue and
+# then in the listen backlog.
+class PooledHTTPServer(ThreadingMixIn, HTTPServer):
+    workers = 32
+    request_queue_size = 128 # Listen backlog; the default is 5.
+
+    def __init__(self, address, handler):
+        HTTPServer.__init__(self, address, handler)
+        self.pending = Queue.Queue(self.workers)
+        for i in range(self.workers):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+
+    def work(self):
+        while True:
+            self.process_request_thread(*self.pending.get())
+
+    def process_request(self, request, client_address):
+        self.pending.put((request, client_address))
+
 try:
-    server = HTTPServer(('', PORT), handler)
+    server = PooledHTTPServer(('', PORT), handler)
     print 'Started addition FS on port ' , PORT
     server.serve_forever()
 
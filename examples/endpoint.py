@@ -19,57 +19,103 @@
 
 # An example external service.  Not an action executor.  Just an
 # external service that a Javascript action can POST to.  This service
-# tries to make JSON from what it hears.  Then writes that JSON to
-# stdout and the client
+# tries to make JSON from what it hears.  Then logs that JSON and
+# writes it to the client
 
 # curl -d '{"likes":"tacos"}' http://localhost:6668/
 
 from BaseHTTPServer import BaseHTTPRequestHandler,HTTPServer
+from SocketServer import ThreadingMixIn
+import Queue
+import threading
 from urlparse import urlparse, parse_qs
 import json
+try:
+    import ujson as fastjson # Faster JSON, if it's installed.
+except ImportError:
+    fastjson = json
 import logging
 
 PORT = 6668
 
-logging.basicConfig(level=logging.DEBUG)
+# Log what we hear, but leave the per-request access log at DEBUG.
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Complete status lines and headers, built once per process.  We
+# close the connection after every reply, and say so up front.
+JSON_HEAD = 'HTTP/1.0 200 OK\r\nContent-type: application/json\r\nConnection: close\r\n\r\n'
 
 def protest (response, message):
-    logging.warning(message)
-    response.send_response(200)
-    response.send_header('Content-type','application/json')
-    response.end_headers()
-    response.wfile.write(message)
+    logger.warning(message)
+    response.log_request(200)
+    response.wfile.write(JSON_HEAD + message)
 
 def respond (out, js):
-    logging.info(js)
-    print 'data ', js
-    out.send_response(200)
-    out.send_header('Content-type','application/json')
-    out.end_headers()
-    out.wfile.write(js + "\n")
+    logger.info('data %s', js)
+    out.log_request(200)
+    out.wfile.write(JSON_HEAD + js + "\n")
 
 class handler(BaseHTTPRequestHandler):
+    # Our replies are small; send them without waiting on Nagle.
+    disable_nagle_algorithm = True
+    # Buffer the status line, headers and body so they go out in one
+    # send when the request finishes rather than one send apiece.
+    wbufsize = -1
+
+    # Log each request through logger rather than straight to stderr.
+    def log_message(self, format, *args):
+        logger.debug("%s " + format, self.client_address[0], *args)
+
+    # But keep send_error's complaints visible.
+    def log_error(self, format, *args):
+        logger.warning("%s " + format, self.client_address[0], *args)
+
     def do_GET(self):
         try:
             args = parse_qs(urlparse(self.path).query)
-            respond(self, json.dumps(args))
+            respond(self, fastjson.dumps(args))
         except Exception as broke:
             protest(self, str(broke))
     def do_POST(self):
         try:
             content_len = int(self.headers.getheader('content-length'))
             body = self.rfile.read(content_len)
-            logging.info("body: " + body)
+            logger.info('body: %s', body)
             if body[0] == '{':
                 respond(self, body)
             else:
                 args = parse_qs(body)
-                respond(self, json.dumps(args))
+                respond(self, fastjson.dumps(args))
         except Exception as broke:
             protest(self, str(broke))
 
+# Handle requests on a fixed pool of threads, started up front, so
+# that one slow request (say, waiting on an upstream service) doesn't
+# hold up the rest and a burst of clients can't start a thread apiece.
+# When every worker is busy, new connections wait in the queue and
+# then in the listen backlog.
+class PooledHTTPServer(ThreadingMixIn, HTTPServer):
+    workers = 32
+    request_queue_size = 128 # Listen backlog; the default is 5.
+
+    def __init__(self, address, handler):
+        HTTPServer.__init__(self, address, handler)
+        self.pending = Queue.Queue(self.workers)
+        for i in range(self.workers):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+
+    def work(self):
+        while True:
+            self.process_request_thread(*self.pending.get())
+
+    def process_request(self, request, client_address):
+        self.pending.put((request, client_address))
+
 try:
-    server = HTTPServer(('', PORT), handler)
+    server = PooledHTTPServer(('', PORT), handler)
     print 'Started example action endpoint on port ' , PORT
     server.serve_forever()
 
@@ -25,10 +25,10 @@
 
 # Pattern must specify at least one additional property from the set
 
-legalProperties = {"Actors","Awards","Country","Director","Genre","Language",
-                   "Metascore","Plot","Poster","Rated","Released","Response",
-                   "Runtime","Title","Type","Writer","Year","imdbID","imdbRating",
-                   "imdbVotes"}
+legalProperties = frozenset({"Actors","Awards","Country","Director","Genre",
+                             "Language","Metascore","Plot","Poster","Rated",
+                             "Released","Response","Runtime","Title","Type",
+                             "Writer","Year","imdbID","imdbRating","imdbVotes"})
 
 # A more principled approach would allow the pattern to specify only a
 # single additional property, but that decision is a separate
@@ -38,30 +38,131 @@ legalProperties = {"Actors","Awards","Country","Director","Genre","Language",
 #
 # curl -d '{"titleQuery":"t=True%20Grit&y=1969","Actors":"?actors","Runtime":"?runtime"}' 'http://localhost:6666/facts/search'
 #
+# A list of patterns is answered with one result per pattern, and
+# their movies are fetched concurrently.
+#
 
 from BaseHTTPServer import BaseHTTPRequestHandler,HTTPServer
-import cgi # Better way now?
+from SocketServer import ThreadingMixIn
+import Queue
 import json
+import logging
+try:
+    import ujson as fastjson # Faster JSON, if it's installed.
+except ImportError:
+    fastjson = json
 import urllib2
-import urllib
+try:
+    import requests # Pooled keep-alive connections, if it's installed.
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None
+from multiprocessing.pool import ThreadPool
+import threading
+import time
 
 PORT = 6666
 
-def protest (response, message):
-    response.send_response(200)
-    response.send_header('Content-type','text/plain')
-    response.end_headers()
-    response.wfile.write(message) # Should probably be JSON
+# Each request's details are logged at DEBUG, which is off by default
+# to keep logging out of the request path.
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
 
+# Complete status lines and headers, built once per process.  We
+# close the connection after every reply, and say so up front.
+JSON_HEAD = 'HTTP/1.0 200 OK\r\nContent-type: application/json\r\nConnection: close\r\n\r\n'
+TEXT_HEAD = 'HTTP/1.0 200 OK\r\nContent-type: text/plain\r\nConnection: close\r\n\r\n'
+
+def protest (response, message):
+    response.log_request(200)
+    response.wfile.write(TEXT_HEAD + message) # Should probably be JSON
+
+# Seconds to wait on the upstream service.
+TIMEOUT = 5
+
+if requests:
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=10, pool_maxsize=50))
+else:
+    opener = urllib2.build_opener()
+
+# Returns the body at uri, reusing connections to the upstream service
+# when requests is available.
+def fetch (uri):
+    if requests:
+        r = session.get(uri, timeout=TIMEOUT)
+        r.raise_for_status()
+        return r.content
+    return opener.open(uri, timeout=TIMEOUT).read()
+
+# Remember a one-argument function's results for ttl seconds.  Holds
+# at most size results and forgets them all when it fills up.
+def cached (ttl, size=1024):
+    def wrap (f):
+        results = {}
+        lock = threading.Lock()
+        def get (key):
+            now = time.time()
+            with lock:
+                hit = results.get(key)
+            if hit and now < hit[0]:
+                return hit[1]
+            value = f(key)
+            with lock:
+                if len(results) >= size:
+                    results.clear()
+                results[key] = (now + ttl, value)
+            return value
+        return get
+    return wrap
+
+@cached(24 * 60 * 60)
 def getMovie (query):
     uri = "http://www.omdbapi.com/?" + query
     # uri += urllib.quote_plus(locale)
-    print "uri ", uri
-    report = json.load(urllib2.urlopen(uri))
-    print json.dumps(report, sort_keys=True, indent=2, separators=(',', ': '))
+    logger.debug('uri %s', uri)
+    report = fastjson.loads(fetch(uri))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps(report, sort_keys=True, indent=2, separators=(',', ': ')))
     return report
 
+# Upstream calls are I/O-bound, so a batch of patterns fans them out
+# over a pool of threads.
+pool = ThreadPool(16)
+
+def getMovies (querys):
+    if len(querys) == 1:
+        return [getMovie(querys[0])]
+    return pool.map(getMovie, querys)
+
+# Returns what's wrong with the pattern's properties, if anything.
+# Every property must be legal, and every value must be a variable.
+def checkPattern (m):
+    illegal = m.viewkeys() - legalProperties
+    if illegal:
+        return "Illegal property " + min(illegal) + ".\n"
+    for v in m.itervalues():
+        if not v.startswith("?"):
+            return "Value " + v + " must be a variable.\n"
+        if len(v) < 2:
+            return "Need an named variable for " + v  + ".\n"
+    return None
+
 class handler(BaseHTTPRequestHandler):
+    # Our replies are small; send them without waiting on Nagle.
+    disable_nagle_algorithm = True
+    # Buffer the status line, headers and body so they go out in one
+    # send when the request finishes rather than one send apiece.
+    wbufsize = -1
+
+    # Log each request through logger rather than straight to stderr.
+    def log_message(self, format, *args):
+        logger.debug("%s " + format, self.client_address[0], *args)
+
+    # But keep send_error's complaints visible.
+    def log_error(self, format, *args):
+        logger.warning("%s " + format, self.client_address[0], *args)
+
     def do_GET(self):
         protest(self, "You should POST with json.\n")
         return
@@ -74,56 +175,68 @@ class handler(BaseHTTPRequestHandler):
             content_length = int(self.headers['Content-Length'])
             js = self.rfile.read(content_length)
 
-            m = json.loads(js)
-    
-            if 'titleQuery' not in m:
-                protest(self, "Need titleQuery.\n")
-                return
-            titleQuery = m["titleQuery"]
-            del m["titleQuery"]
-    
-            for p in m:
-                if p not in legalProperties:
-                    protest(self, "Illegal property " + p + ".\n")
-                    return
-                v = m[p]
-                if not v.startswith("?"):
-                    protest(self, "Value " + v + " must be a variable.\n")
+            m = fastjson.loads(js)
+            patterns = m if isinstance(m, list) else [m]
+
+            titleQueries = []
+            for m in patterns:
+                if 'titleQuery' not in m:
+                    protest(self, "Need titleQuery.\n")
                     return
-                if len(v) < 2:
-                    protest(self, "Need an named variable for " + v  + ".\n")
+                titleQueries.append(m["titleQuery"])
+                del m["titleQuery"]
+
+                problem = checkPattern(m)
+                if problem:
+                    protest(self, problem)
                     return
 
-            o = getMovie(titleQuery)
-            print o
+            found = []
+            for m, o in zip(patterns, getMovies(titleQueries)):
+                logger.debug('%s', o)
 
-            bindings = {}
-            satisfied = True
-            for p in m:
-                print p, ": ", o[p], "\n"
-                if p in o:
-                    bindings[m[p]] = o[p]
+                # Only bind if o has every property the pattern wants.
+                if m.viewkeys() <= o.viewkeys():
+                    bindings = {v: o[p] for p, v in m.iteritems()}
+                    found.append({"Bindingss": [bindings]})
                 else:
-                    satisfied = False
-                    break
-
-            if satisfied:
-                js = json.dumps(bindings)
-                response = '{"Found":[{"Bindingss":[%s]}]}' % (js)
-            else:
-                response = '{"Found":[{"Bindingss":[]}]}'
-
-            self.send_response(200)
-            self.send_header('Content-type','application/json')
-            self.end_headers()
-            print 'response ', response
-            self.wfile.write(response)
+                    found.append({"Bindingss": []})
+
+            response = fastjson.dumps({"Found": found})
+
+            logger.debug('response %s', response)
+            self.log_request(200)
+            self.wfile.write(JSON_HEAD + response)
             
         except Exception as broke:
             protest(self, str(broke))
 
+# Handle requests on a fixed pool of threads, started up front, so
+# that one slow request (say, waiting on an upstream service) doesn't
+# hold up the rest and a burst of clients can't start a thread apiece.
+# When every worker is busy, new connections wait in the queue and
+# then in the listen backlog.
+class PooledHTTPServer(ThreadingMixIn, HTTPServer):
+    workers = 32
+    request_queue_size = 128 # Listen backlog; the default is 5.
+
+    def __init__(self, address, handler):
+        HTTPServer.__init__(self, address, handler)
+        self.pending = Queue.Queue(self.workers)
+        for i in range(self.workers):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+
+    def work(self):
+        while True:
+            self.process_request_thread(*self.pending.get())
+
+    def process_request(self, request, client_address):
+        self.pending.put((request, client_address))
+
 try:
-    server = HTTPServer(('', PORT), handler)
+    server = PooledHTTPServer(('', PORT), handler)
     print 'Started weather FS on port ' , PORT
     server.serve_forever()
 
@@ -25,7 +25,7 @@
 
 # Pattern must specify at least one additional property from the set
 
-legalProperties = {"bid", "ask", "change", "percentChange", "lastTradeSize"}
+legalProperties = frozenset({"bid", "ask", "change", "percentChange", "lastTradeSize"})
 
 # curl 'http://download.finance.yahoo.com/d/quotes.csv?s=CMCSA&f=abc1p2k3&e=.csv'
 
@@ -39,40 +39,146 @@ legalProperties = {"bid", "ask", "change", "percentChange", "lastTradeSize"}
 #
 # curl -d '{"symbol":"CMCSA","bid":"?bid","ask":"?ask"}' 'http://localhost:6666/facts/search'
 #
+# A list of patterns is answered with one result per pattern, and
+# their quotes are fetched concurrently:
+#
+# curl -d '[{"symbol":"CMCSA","bid":"?bid"},{"symbol":"AAPL","bid":"?bid"}]' 'http://localhost:6666/facts/search'
+#
 
 from BaseHTTPServer import BaseHTTPRequestHandler,HTTPServer
-import cgi # Better way now?
+from SocketServer import ThreadingMixIn
+import Queue
 import json
+import logging
+try:
+    import ujson as fastjson # Faster JSON, if it's installed.
+except ImportError:
+    fastjson = json
 import urllib2
-import urllib
-import re
+try:
+    import requests # Pooled keep-alive connections, if it's installed.
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None
+from multiprocessing.pool import ThreadPool
+import threading
+import time
 
 PORT = 6666
 
+# Each request's details are logged at DEBUG, which is off by default
+# to keep logging out of the request path.
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# Characters to drop from a quote before parsing its numbers.
+QUOTE_JUNK = '%"\n'
+
+# The quote's fields, in the order the f=abc1p2k3 query asks for them.
+QUOTE_FIELDS = ("bid", "ask", "change", "percentChange", "lastTradeSize")
+
+# Complete status lines and headers, built once per process.  We
+# close the connection after every reply, and say so up front.
+JSON_HEAD = 'HTTP/1.0 200 OK\r\nContent-type: application/json\r\nConnection: close\r\n\r\n'
+TEXT_HEAD = 'HTTP/1.0 200 OK\r\nContent-type: text/plain\r\nConnection: close\r\n\r\n'
+
 def protest (response, message):
-    response.send_response(200)
-    response.send_header('Content-type','text/plain')
-    response.end_headers()
-    response.wfile.write(message) # Should probably be JSON
+    response.log_request(200)
+    response.wfile.write(TEXT_HEAD + message) # Should probably be JSON
+
+# Seconds to wait on the upstream service.
+TIMEOUT = 5
+
+if requests:
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=10, pool_maxsize=50))
+else:
+    opener = urllib2.build_opener()
+
+# Returns the body at uri, reusing connections to the upstream service
+# when requests is available.
+def fetch (uri):
+    if requests:
+        r = session.get(uri, timeout=TIMEOUT)
+        r.raise_for_status()
+        return r.content
+    return opener.open(uri, timeout=TIMEOUT).read()
 
+# Remember a one-argument function's results for ttl seconds.  Holds
+# at most size results and forgets them all when it fills up.
+def cached (ttl, size=1024):
+    def wrap (f):
+        results = {}
+        lock = threading.Lock()
+        def get (key):
+            now = time.time()
+            with lock:
+                hit = results.get(key)
+            if hit and now < hit[0]:
+                return hit[1]
+            value = f(key)
+            with lock:
+                if len(results) >= size:
+                    results.clear()
+                results[key] = (now + ttl, value)
+            return value
+        return get
+    return wrap
+
+@cached(60)
 def getQuote (symbol):
     uri = "http://download.finance.yahoo.com/d/quotes.csv?s=" + symbol + "&f=abc1p2k3&e=.csv"
-    print "uri ", uri
-    line = urllib2.urlopen(uri).read().strip()
-    print "got ", line, "\n"
-    line = re.sub(r'[%"\n]+', "", line)
-    print "clean ", line, "\n"
-    data = line.split(",")
-    ns = map(float, data)
-    q = {}
-    q["bid"] = ns[0]
-    q["ask"] = ns[1]
-    q["change"] = ns[2]
-    q["percentChange"] = ns[3]
-    q["lastTradeSize"] = ns[4]
-    return q
+    logger.debug('uri %s', uri)
+    line = fetch(uri)
+    logger.debug('got %s', line)
+    return dict(zip(QUOTE_FIELDS, parseQuote(line)))
+
+# Returns a quote line's numbers.  translate() drops the junk in one C
+# pass and float() ignores surrounding whitespace, so there's no need
+# to strip() first.
+def parseQuote (line):
+    ns = map(float, line.translate(None, QUOTE_JUNK).split(","))
+    if len(ns) < len(QUOTE_FIELDS):
+        raise ValueError("Short quote " + line.strip() + ".\n")
+    return ns
+
+# Upstream calls are I/O-bound, so a batch of patterns fans them out
+# over a pool of threads.
+pool = ThreadPool(16)
+
+def getQuotes (symbols):
+    if len(symbols) == 1:
+        return [getQuote(symbols[0])]
+    return pool.map(getQuote, symbols)
+
+# Returns what's wrong with the pattern's properties, if anything.
+# Every property must be legal, and every value must be a variable.
+def checkPattern (m):
+    illegal = m.viewkeys() - legalProperties
+    if illegal:
+        return "Illegal property " + min(illegal) + ".\n"
+    for v in m.itervalues():
+        if not v.startswith("?"):
+            return "Value " + v + " must be a variable.\n"
+        if len(v) < 2:
+            return "Need an named variable for " + v  + ".\n"
+    return None
 
 class handler(BaseHTTPRequestHandler):
+    # Our replies are small; send them without waiting on Nagle.
+    disable_nagle_algorithm = True
+    # Buffer the status line, headers and body so they go out in one
+    # send when the request finishes rather than one send apiece.
+    wbufsize = -1
+
+    # Log each request through logger rather than straight to stderr.
+    def log_message(self, format, *args):
+        logger.debug("%s " + format, self.client_address[0], *args)
+
+    # But keep send_error's complaints visible.
+    def log_error(self, format, *args):
+        logger.warning("%s " + format, self.client_address[0], *args)
+
     def do_GET(self):
         protest(self, "You should POST with json.\n")
         return
@@ -85,57 +191,69 @@ class handler(BaseHTTPRequestHandler):
             content_length = int(self.headers['Content-Length'])
             js = self.rfile.read(content_length)
 
-            m = json.loads(js)
-    
-            if 'symbol' not in m:
-                protest(self, "Need symbol.\n")
-                return
-            symbol = m["symbol"]
-            del m["symbol"]
-    
-            for p in m:
-                if p not in legalProperties:
-                    protest(self, "Illegal property " + p + ".\n")
-                    return
-                v = m[p]
-                if not v.startswith("?"):
-                    protest(self, "Value " + v + " must be a variable.\n")
+            m = fastjson.loads(js)
+            patterns = m if isinstance(m, list) else [m]
+
+            symbols = []
+            for m in patterns:
+                if 'symbol' not in m:
+                    protest(self, "Need symbol.\n")
                     return
-                if len(v) < 2:
-                    protest(self, "Need an named variable for " + v  + ".\n")
+                symbols.append(m["symbol"])
+                del m["symbol"]
+
+                problem = checkPattern(m)
+                if problem:
+                    protest(self, problem)
                     return
 
-            q = getQuote(symbol)
-            print q, "\n"
+            found = []
+            for m, q in zip(patterns, getQuotes(symbols)):
+                logger.debug('%s', q)
 
-            bindings = {}
-            satisfied = True
-            for p in m:
-                print p, ": ", q[p], "\n"
-                if p in q:
-                    bindings[m[p]] = q[p]
+                # Only bind if q has every property the pattern wants.
+                if m.viewkeys() <= q.viewkeys():
+                    bindings = {v: q[p] for p, v in m.iteritems()}
+                    found.append({"Bindingss": [bindings]})
                 else:
-                    satisfied = False
-                    break
-
-            if satisfied:
-                js = json.dumps(bindings)
-                response = '{"Found":[{"Bindingss":[%s]}]}' % (js)
-            else:
-                response = '{"Found":[{"Bindingss":[]}]}'
-
-            self.send_response(200)
-            self.send_header('Content-type','application/json')
-            self.end_headers()
-            print 'response ', response
-            self.wfile.write(response)
+                    found.append({"Bindingss": []})
+
+            response = fastjson.dumps({"Found": found})
+
+            logger.debug('response %s', response)
+            self.log_request(200)
+            self.wfile.write(JSON_HEAD + response)
             
         except Exception as broke:
-            print broke, "\n"
+            logger.warning('%s', broke)
             protest(self, str(broke))
 
+# Handle requests on a fixed pool of threads, started up front, so
+# that one slow request (say, waiting on an upstream service) doesn't
+# hold up the rest and a burst of clients can't start a thread apiece.
+# When every worker is busy, new connections wait in the queue and
+# then in the listen backlog.
+class PooledHTTPServer(ThreadingMixIn, HTTPServer):
+    workers = 32
+    request_queue_size = 128 # Listen backlog; the default is 5.
+
+    def __init__(self, address, handler):
+        HTTPServer.__init__(self, address, handler)
+        self.pending = Queue.Queue(self.workers)
+        for i in range(self.workers):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+
+    def work(self):
+        while True:
+            self.process_request_thread(*self.pending.get())
+
+    def process_request(self, request, client_address):
+        self.pending.put((request, client_address))
+
 try:
-    server = HTTPServer(('', PORT), handler)
+    server = PooledHTTPServer(('', PORT), handler)
     print 'Started weather FS on port ' , PORT
     server.serve_forever()
 
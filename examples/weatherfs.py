@@ -31,33 +31,122 @@ APPID="2de143494c0b295cca9337e1e96b00e0"
 # Again: Just as an example external FS.
 
 # curl -d '{"locale":"Austin,TX","temp":"?x"}' 'http://localhost:6666/facts/search'
-# {"Found":[{"Bindingss":[{"?x":11.500000}]}]}
+# {"Found":[{"Bindingss":[{"?x":11.5}]}]}
+
+# A list of patterns is answered with one result per pattern, and
+# their weather is fetched concurrently.
 
 from BaseHTTPServer import BaseHTTPRequestHandler,HTTPServer
-import cgi # Better way now?
+from SocketServer import ThreadingMixIn
+import Queue
 import json
+import logging
+try:
+    import ujson as fastjson # Faster JSON, if it's installed.
+except ImportError:
+    fastjson = json
 import urllib2
+try:
+    import requests # Pooled keep-alive connections, if it's installed.
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None
 import urllib
+from multiprocessing.pool import ThreadPool
+import threading
+import time
 
 PORT = 6666
 
-def protest (response, message):
-    response.send_response(200)
-    response.send_header('Content-type','text/plain')
-    response.end_headers()
-    response.wfile.write(message) # Should probably be JSON
+# Each request's details are logged at DEBUG, which is off by default
+# to keep logging out of the request path.
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
 
+# Complete status lines and headers, built once per process.  We
+# close the connection after every reply, and say so up front.
+JSON_HEAD = 'HTTP/1.0 200 OK\r\nContent-type: application/json\r\nConnection: close\r\n\r\n'
+TEXT_HEAD = 'HTTP/1.0 200 OK\r\nContent-type: text/plain\r\nConnection: close\r\n\r\n'
+
+def protest (response, message):
+    response.log_request(200)
+    response.wfile.write(TEXT_HEAD + message) # Should probably be JSON
+
+# Seconds to wait on the upstream service.
+TIMEOUT = 5
+
+if requests:
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=10, pool_maxsize=50))
+else:
+    opener = urllib2.build_opener()
+
+# Returns the body at uri, reusing connections to the upstream service
+# when requests is available.
+def fetch (uri):
+    if requests:
+        r = session.get(uri, timeout=TIMEOUT)
+        r.raise_for_status()
+        return r.content
+    return opener.open(uri, timeout=TIMEOUT).read()
+
+# Remember a one-argument function's results for ttl seconds.  Holds
+# at most size results and forgets them all when it fills up.
+def cached (ttl, size=1024):
+    def wrap (f):
+        results = {}
+        lock = threading.Lock()
+        def get (key):
+            now = time.time()
+            with lock:
+                hit = results.get(key)
+            if hit and now < hit[0]:
+                return hit[1]
+            value = f(key)
+            with lock:
+                if len(results) >= size:
+                    results.clear()
+                results[key] = (now + ttl, value)
+            return value
+        return get
+    return wrap
+
+@cached(60)
 def getWeather (locale):
     uri = "http://api.openweathermap.org/data/2.5/weather?appid=" + APPID
     uri += "&units=metric&q="
     uri += urllib.quote_plus(locale)
-    print "uri ", uri
-    report = json.load(urllib2.urlopen(uri))
-    print 'Got response'
-    print json.dumps(report, sort_keys=True, indent=2, separators=(',', ': '))
+    logger.debug('uri %s', uri)
+    report = fastjson.loads(fetch(uri))
+    logger.debug('Got response')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps(report, sort_keys=True, indent=2, separators=(',', ': ')))
     return report
 
+# Upstream calls are I/O-bound, so a batch of patterns fans them out
+# over a pool of threads.
+pool = ThreadPool(16)
+
+def getWeathers (locales):
+    if len(locales) == 1:
+        return [getWeather(locales[0])]
+    return pool.map(getWeather, locales)
+
 class handler(BaseHTTPRequestHandler):
+    # Our replies are small; send them without waiting on Nagle.
+    disable_nagle_algorithm = True
+    # Buffer the status line, headers and body so they go out in one
+    # send when the request finishes rather than one send apiece.
+    wbufsize = -1
+
+    # Log each request through logger rather than straight to stderr.
+    def log_message(self, format, *args):
+        logger.debug("%s " + format, self.client_address[0], *args)
+
+    # But keep send_error's complaints visible.
+    def log_error(self, format, *args):
+        logger.warning("%s " + format, self.client_address[0], *args)
+
     def do_GET(self):
         protest(self, "You should POST with json.\n")
         return
@@ -70,46 +159,77 @@ class handler(BaseHTTPRequestHandler):
             content_length = int(self.headers['Content-Length'])
             js = self.rfile.read(content_length)
     
-            # We want {"locale":constant,"temp":variable}. 
-            m = json.loads(js)
-            print m, "\n"
-    
-            if 'locale' not in m:
-                protest(self, "Need locale (constant: string).\n")
-                return
-            locale = m["locale"]
-            print 'locale ', locale
-    
-            if 'temp' not in m:
-                protest(self, "Need temp (variable).\n")
-                return
-            tempVar = str(m["temp"])
-            print 'tempVar ', tempVar
-    
-            if not tempVar.startswith("?"):
-                protest(self, "Temp must be a variable.\n")
-                return
-    
-            if len(tempVar) < 2:
-                protest(self, "Need an named variable for temp.\n")
-                return
-
-            w = getWeather(locale)
-            temp = w['main']['temp']
-            print 'temp ', temp
-
-            self.send_response(200)
-            self.send_header('Content-type','application/json')
-            self.end_headers()
-            response = '{"Found":[{"Bindingss":[{"%s":%f}]}]}' % (tempVar, temp)
-            print 'response ', response
-            self.wfile.write(response)
+            # We want {"locale":constant,"temp":variable} or a list of them.
+            m = fastjson.loads(js)
+            logger.debug('%s', m)
+            patterns = m if isinstance(m, list) else [m]
+
+            locales = []
+            tempVars = []
+            for m in patterns:
+                if 'locale' not in m:
+                    protest(self, "Need locale (constant: string).\n")
+                    return
+                locale = m["locale"]
+                logger.debug('locale %s', locale)
+
+                if 'temp' not in m:
+                    protest(self, "Need temp (variable).\n")
+                    return
+                tempVar = str(m["temp"])
+                logger.debug('tempVar %s', tempVar)
+
+                if not tempVar.startswith("?"):
+                    protest(self, "Temp must be a variable.\n")
+                    return
+
+                if len(tempVar) < 2:
+                    protest(self, "Need an named variable for temp.\n")
+                    return
+
+                locales.append(locale)
+                tempVars.append(tempVar)
+
+            found = []
+            for tempVar, w in zip(tempVars, getWeathers(locales)):
+                temp = w['main']['temp']
+                logger.debug('temp %s', temp)
+                found.append({"Bindingss": [{tempVar: temp}]})
+
+            response = fastjson.dumps({"Found": found})
+            logger.debug('response %s', response)
+            self.log_request(200)
+            self.wfile.write(JSON_HEAD + response)
             
         except Exception as broke:
             protest(self, str(broke))
 
+# Handle requests on a fixed pool of threads, started up front, so
+# that one slow request (say, waiting on an upstream service) doesn't
+# hold up the rest and a burst of clients can't start a thread apiece.
+# When every worker is busy, new connections wait in the queue and
+# then in the listen backlog.
+class PooledHTTPServer(ThreadingMixIn, HTTPServer):
+    workers = 32
+    request_queue_size = 128 # Listen backlog; the default is 5.
+
+    def __init__(self, address, handler):
+        HTTPServer.__init__(self, address, handler)
+        self.pending = Queue.Queue(self.workers)
+        for i in range(self.workers):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+
+    def work(self):
+        while True:
+            self.process_request_thread(*self.pending.get())
+
+    def process_request(self, request, client_address):
+        self.pending.put((request, client_address))
+
 try:
-    server = HTTPServer(('', PORT), handler)
+    server = PooledHTTPServer(('', PORT), handler)
     print 'Started weather FS on port ' , PORT
     server.serve_forever()
 